@@ -1,30 +1,56 @@
 # app.py
-from flask import Flask, request, jsonify
+from flask import Flask, request
 from dotenv import load_dotenv
+import asyncio
+import functools
+import hashlib
+import json
 import os
-import inspect
-import mimetypes
+import mmap
+import queue
 import re
-from PIL import Image # For potentially processing image files
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import io # For working with image bytes
+from pathlib import Path
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+import orjson
 
-# Gradio client imports
-from gradio_client import Client, handle_file
+# Prediction cache imports
+from cachetools import TTLCache
 
-# Google Generative AI imports
-import google.generativeai as genai
+# PIL, imagehash, gradio_client and google.generativeai take seconds to import between them, so they
+# are imported inside the functions that use them, off the cold-start path (see "Startup" below)
 
+app = Flask(__name__)
 
-load_dotenv() # Load environment variables from .env file
+def ojsonify(obj):
+    """Like flask.jsonify, but serialized with orjson (Rust) instead of the stdlib json module."""
+    return app.response_class(orjson.dumps(obj), mimetype='application/json')
 
-app = Flask(__name__)
+# --- Shared pool for blocking calls ---
+# Flask runs an async view to completion with asgiref's async_to_sync, so the gunicorn thread serving the
+# request stays blocked until it returns either way; concurrency between requests comes from the gthread
+# workers (see Procfile). The pool is what lets one request overlap its own blocking calls (the Gradio
+# call and the image prefetch). asyncio.to_thread would use the event loop's default executor, and Flask
+# creates a new loop (and so a new executor) for every async view; one module-level pool is shared by all
+# requests instead. Sized for gunicorn's 16 threads per worker, each overlapping up to two blocking calls.
+_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="blocking-io")
+
+def run_blocking(fn, *args, **kwargs):
+    """Run a blocking call on the shared pool and return an awaitable for its result."""
+    return asyncio.get_running_loop().run_in_executor(_EXECUTOR, functools.partial(fn, *args, **kwargs))
 
 # --- Configuration from .env ---
-# Get the directory of the current script (app.py)
-current_script_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
-# Construct the path to the .env file, which is one level up (in D:\Projects\timizi\backend\)
-dotenv_path = os.path.join(current_script_dir, '../.env')
-load_dotenv(dotenv_path=dotenv_path)
+# A .env next to this script wins, then the shared one a level up (in D:\Projects\timizi\backend\).
+# Explicit paths avoid python-dotenv's frame inspection and directory walk when searching for one.
+current_script_dir = Path(__file__).resolve().parent
+for dotenv_path in (current_script_dir / '.env', current_script_dir.parent / '.env'):
+    load_dotenv(dotenv_path=dotenv_path)
 
 HF_TOKEN = os.getenv("HF_TOKEN")
 if not HF_TOKEN:
@@ -36,21 +62,402 @@ if not GOOGLE_API_KEY:
     print("Error: Google AI Studio API Key (GOOGLE_API_KEY) not found in environment variables.")
     exit(1)
 
+# --- Gemini prompt template ---
+# Static instructions shared by every request, sent as the model's system instruction. The Norwood
+# scale itself is the per-request user message ("Norwood Scale: N").
+GEMINI_TEMPLATE = """
+You will be given a hair analysis result as "Norwood Scale: N", and possibly a hair segmentation image. Based on that Norwood Scale, and considering the provided hair segmentation image (if available), generate a structured report. This report aims to provide confidence in the hair analysis.
+
+**SYMPTOMS:**
+Describe the typical observable symptoms for the given Norwood Scale. Max 2 lines.
+
+**MAIN ISSUES (Confidence in Specific Concerns):**
+List up to 4 primary hair loss issues commonly associated with this Norwood Scale. For each, provide *only* the issue name and an estimated percentage, formatted strictly as "Issue Name (Percentage%)". These are AI estimations. No conversational text or extra explanations for each issue.
+
+**OVERALL HAIR HEALTH PERCENTAGE (Overall Confidence):**
+Based on the given Norwood Scale, provide an estimated overall hair health percentage, e.g., "95%". This is an AI estimation of the overall condition.
+
+**CAUSES:**
+Explain common underlying causes for hair loss at this Norwood Scale. Max 2 lines.
+
+**TREATMENTS:**
+List general management or treatment approaches for this Norwood Scale. Keep it concise. Max 4 lines.
+"""
+
+# Gradio outputs are almost always one of these; avoids mimetypes' lazy read of the system mime files
+_EXT_MIME = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.webp': 'image/webp'}
+
+# Gemini downsamples large images internally, so anything bigger only costs upload time
+GEMINI_IMAGE_MAX_SIZE = 768 # px, long edge
+GEMINI_IMAGE_JPEG_QUALITY = 85
+
+def prepare_gemini_image(image_path):
+    """Return (upload source, mime type) for the image, re-encoded as a smaller JPEG if it's oversized.
+
+    Anything Pillow can't open or re-encode is uploaded unchanged, as before resizing was added.
+    """
+    from PIL import Image
+    original_mime_type = _EXT_MIME.get(os.path.splitext(image_path)[1].lower(), 'image/jpeg')
+    try:
+        # Decode straight from the page cache via mmap rather than copying the file into a Python buffer
+        with open(image_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, Image.open(mm) as im:
+            if max(im.size) <= GEMINI_IMAGE_MAX_SIZE:
+                # Already small enough: upload the file as-is
+                return image_path, original_mime_type
+            im.thumbnail((GEMINI_IMAGE_MAX_SIZE, GEMINI_IMAGE_MAX_SIZE), Image.LANCZOS)
+            buf = io.BytesIO()
+            im.convert('RGB').save(buf, 'JPEG', quality=GEMINI_IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        print(f"Could not resize segmentation image {image_path}, uploading it unchanged: {e}")
+        return image_path, original_mime_type
+    buf.seek(0)
+    return buf, 'image/jpeg'
+
+# --- Gemini response parsing ---
+# Section headers as they appear in GEMINI_TEMPLATE, mapped to keys in the response for Flutter
+HEADER_TO_KEY = {
+    "SYMPTOMS:": "symptoms",
+    "MAIN ISSUES (Confidence in Specific Concerns):": "main_issues",
+    "OVERALL HAIR HEALTH PERCENTAGE (Overall Confidence):": "overall_health_percentage",
+    "CAUSES:": "causes",
+    "TREATMENTS:": "treatments"
+}
+# Any known header; matched against the response after markdown '*'s are stripped
+_SECTION_RE = re.compile("(" + "|".join(re.escape(header) for header in HEADER_TO_KEY) + ")")
+# One main issue per line: optional '-' list marker, issue name (non-greedy), then (percentage%)
+_ISSUE_RE = re.compile(r"^[ \t]*(?:-\s*)?(.+?)\s*\((\d+)%\)", re.MULTILINE)
+# Leading list marker on an issue line that doesn't match _ISSUE_RE
+_ISSUE_MARKER_RE = re.compile(r"^-\s*")
+
 # --- Initialize Google Generative AI ---
+# UPDATED MODEL NAME: Using gemini-1.5-flash as gemini-pro-vision is deprecated
+GEMINI_MODEL_NAME = 'gemini-1.5-flash'
+
 gemini_model = None
+
 def configure_gemini():
     global gemini_model
     try:
+        import google.generativeai as genai
         genai.configure(api_key=GOOGLE_API_KEY)
-        # UPDATED MODEL NAME: Using gemini-1.5-flash as gemini-pro-vision is deprecated
-        gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-        print("Successfully configured Google Generative AI and loaded gemini-1.5-flash model!")
+        gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=GEMINI_TEMPLATE)
+        print(f"Successfully configured Google Generative AI and loaded {GEMINI_MODEL_NAME} model!")
     except Exception as e:
         print(f"Failed to configure Google Generative AI: {e}")
         gemini_model = None
 
-# Configure Gemini on startup
-configure_gemini()
+def upload_gemini_image(image_path):
+    """Shrink the segmentation image if needed and stream it to Gemini's file store; returns the file handle."""
+    import google.generativeai as genai
+    upload_source, mime_type = prepare_gemini_image(image_path)
+    return genai.upload_file(path=upload_source, mime_type=mime_type)
+
+def delete_uploaded_file(uploaded_file):
+    try:
+        import google.generativeai as genai
+        genai.delete_file(uploaded_file.name)
+    except Exception as e:
+        print(f"Failed to delete uploaded Gemini file {uploaded_file.name}: {e}")
+
+# --- Gemini insight generation ---
+def generate_gemini_text(gemini_prompt_parts):
+    # Called from worker threads: Flask runs each async view on a fresh event loop, and the SDK's async
+    # gRPC client is bound to the loop it was first created on, so the sync client (shared channel) is used
+    from google.api_core import retry as api_retry
+    # Without a deadline the SDK keeps retrying for up to 10 minutes; cap the whole call, retries included
+    gemini_response_obj = gemini_model.generate_content(
+        gemini_prompt_parts,
+        request_options={"timeout": GEMINI_REQUEST_TIMEOUT, "retry": api_retry.Retry(timeout=GEMINI_REQUEST_TIMEOUT)}
+    )
+    gemini_raw_insight = gemini_response_obj.text
+    print(f"Gemini Raw Response:\n{gemini_raw_insight}")
+    return gemini_raw_insight
+
+def generate_gemini_insight(norwood_scale, image_part=None):
+    """Ask Gemini for the report on a Norwood scale (optionally with the segmentation image) and parse it."""
+    if image_part:
+        # Only the Norwood scale varies per request; the instructions live in GEMINI_TEMPLATE
+        gemini_raw_insight = generate_gemini_text([f"Norwood Scale: {norwood_scale}", image_part])
+    else:
+        # Text-only reports can share a Gemini call with other concurrent requests
+        gemini_raw_insight = submit_gemini_report(norwood_scale).result(timeout=GEMINI_BATCH_TIMEOUT)
+    return parse_gemini_insight(gemini_raw_insight, norwood_scale)
+
+# --- Gemini micro-batching ---
+# Text-only report requests are queued and a single batcher thread folds up to GEMINI_BATCH_SIZE of
+# them, arriving within GEMINI_BATCH_WINDOW of each other, into one Gemini call. Each report in the
+# combined answer starts with a numbered marker line, which is how it's routed back to its caller.
+GEMINI_BATCH_SIZE = 4
+GEMINI_BATCH_WINDOW = 0.02 # seconds to wait for more requests after the first one arrives
+GEMINI_REQUEST_TIMEOUT = 20 # seconds for one Gemini call, retries included
+# Room for a batched call plus a re-request of a report missing from its answer
+GEMINI_BATCH_TIMEOUT = 45 # seconds a caller waits for its report
+_batch_q = queue.Queue()
+_BATCH_MARKER_RE = re.compile(r"^[*# \t]*=== REPORT (\d+) ===[* \t]*$", re.MULTILINE)
+# Batches run here rather than on the batcher thread, which goes straight back to collecting the next
+# one; kept apart from _EXECUTOR because threads there block waiting on these batches.
+_batch_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="gemini-batch")
+
+def submit_gemini_report(norwood_scale):
+    """Queue a text-only report for the batcher; the returned Future resolves to Gemini's raw text."""
+    future = Future()
+    _batch_q.put((norwood_scale, future))
+    return future
+
+def build_batch_prompt(norwood_scales):
+    entries = "\n\n".join(f"=== REPORT {n} ===\nNorwood Scale: {scale}" for n, scale in enumerate(norwood_scales, 1))
+    return (
+        "Produce a separate report for each of the following hair analysis results. Start each report with "
+        "its marker line exactly as shown (e.g. \"=== REPORT 1 ===\") on a line of its own, followed by the "
+        f"report in the usual format.\n\n{entries}"
+    )
+
+def split_batch_response(text):
+    """Map report number -> report text for every marker found in a batched Gemini answer."""
+    matches = list(_BATCH_MARKER_RE.finditer(text))
+    reports = {}
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        reports[int(match.group(1))] = text[match.end():end].strip()
+    return reports
+
+def run_gemini_batch(batch):
+    try:
+        if len(batch) == 1:
+            norwood_scale, future = batch[0]
+            future.set_result(generate_gemini_text([f"Norwood Scale: {norwood_scale}"]))
+            return
+
+        print(f"Sending batched request for {len(batch)} reports to Google AI Studio (Gemini)...")
+        reports = split_batch_response(generate_gemini_text([build_batch_prompt([scale for scale, _ in batch])]))
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    for n, (norwood_scale, future) in enumerate(batch, 1):
+        if n in reports:
+            future.set_result(reports[n])
+        else:
+            # Gemini dropped or mangled this report's marker; ask for it on its own, in parallel with
+            # any other missing ones
+            _batch_executor.submit(run_gemini_batch, [(norwood_scale, future)])
+
+def batch_loop():
+    while True:
+        batch = [_batch_q.get()]
+        deadline = time.monotonic() + GEMINI_BATCH_WINDOW
+        while len(batch) < GEMINI_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_batch_q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _batch_executor.submit(run_gemini_batch, batch)
+
+threading.Thread(target=batch_loop, daemon=True, name="gemini-batcher").start()
+
+def split_gemini_report(gemini_raw_insight):
+    """Return the report's sections (keyed like HEADER_TO_KEY) and its parsed main issues."""
+    # --- IMPROVED PARSING OF GEMINI'S RESPONSE ---
+    # '*' is only markdown noise (bold, list bullets), so strip it once up front; the untouched text
+    # is still returned as gemini_raw_insight for debugging
+    normalized = gemini_raw_insight.replace('*', '')
+
+    # Single scan over the response: each section body is the slice between one header match and the next
+    parsed_content = {}
+    matches = list(_SECTION_RE.finditer(normalized))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(normalized)
+        parsed_content[HEADER_TO_KEY[match.group(1)]] = normalized[match.end():end].strip()
+
+    # Parse Main Issues (Most Critical Part to get right)
+    gemini_main_issues = []
+    for line in parsed_content.get('main_issues', "").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = _ISSUE_RE.match(line)
+        if match:
+            issue_name = match.group(1).strip()
+            issue_percent = int(match.group(2))
+            gemini_main_issues.append({"issue": issue_name, "percentage": issue_percent})
+        else:
+            # Fallback: keep issues without a plain "(N%)", e.g. "Crown thinning (high)" or "(30-40%)", at 0%
+            gemini_main_issues.append({"issue": _ISSUE_MARKER_RE.sub("", line), "percentage": 0})
+
+    return parsed_content, gemini_main_issues
+
+def parse_gemini_insight(gemini_raw_insight, norwood_scale):
+    """Split Gemini's report into the fields of the Flutter response."""
+    parsed_content, gemini_main_issues = split_gemini_report(gemini_raw_insight)
+
+    gemini_symptoms = parsed_content.get('symptoms', "No symptoms insight provided.")
+    gemini_causes = parsed_content.get('causes', "No causes insight provided.")
+    gemini_treatments = parsed_content.get('treatments', "No treatment insight provided.")
+    gemini_overall_health_percentage = parsed_content.get('overall_health_percentage', "N/A")
+
+    # Ensure there's at least one main issue if a Norwood scale was detected
+    if not gemini_main_issues and norwood_scale != "N/A":
+        gemini_main_issues.append({"issue": f"Hair loss consistent with Norwood Scale {norwood_scale}", "percentage": 100})
+
+    return {
+        "symptoms": gemini_symptoms,
+        "main_issues": gemini_main_issues,
+        "overall_health_percentage": gemini_overall_health_percentage,
+        "causes": gemini_causes,
+        "treatments": gemini_treatments,
+        "gemini_raw_insight": gemini_raw_insight,
+    }
+
+# --- Precomputed per-Norwood-scale insights ---
+# Without an image the report depends only on the Norwood scale, so the seven possible reports are
+# generated once and persisted to disk; requests then skip Gemini entirely unless they ask for "deep".
+# Entries are tagged with a hash of the model and prompt, so changing either invalidates the file, and
+# expire after NORWOOD_TABLE_TTL so a poor report is eventually regenerated.
+NORWOOD_SCALES = [str(n) for n in range(1, 8)]
+NORWOOD_TABLE_PATH = Path(os.getenv("NORWOOD_TABLE_PATH", current_script_dir / 'norwood_table.json'))
+NORWOOD_TABLE_TTL = int(os.getenv("NORWOOD_TABLE_TTL", 7 * 24 * 3600)) # seconds
+NORWOOD_TABLE_VERSION = hashlib.sha1((GEMINI_MODEL_NAME + GEMINI_TEMPLATE).encode()).hexdigest()
+NORWOOD_TABLE = {} # scale -> {"generated_at": unix time, "insight": parsed report}
+# Held by whichever gunicorn worker is generating the table, so the others wait for its file instead of
+# all sending the same seven reports; a lock older than this is left over from a crashed worker
+NORWOOD_TABLE_LOCK_PATH = NORWOOD_TABLE_PATH.with_name(NORWOOD_TABLE_PATH.name + '.lock')
+NORWOOD_TABLE_LOCK_STALE = 300 # seconds
+# Every (re)build runs through start_background_task with this flag, so at most one runs per process;
+# requests only ever read NORWOOD_TABLE, which builds replace wholesale rather than mutate
+_norwood_building = threading.Event()
+
+def is_fresh_norwood_entry(entry):
+    return time.time() - entry["generated_at"] < NORWOOD_TABLE_TTL
+
+def get_norwood_insight(norwood_scale):
+    """Return the precomputed insight for a scale, or None if it is missing or expired."""
+    entry = NORWOOD_TABLE.get(norwood_scale)
+    if not entry:
+        return None
+    if not is_fresh_norwood_entry(entry):
+        # Serve this request live and regenerate the expired entries in the background
+        start_background_task(_norwood_building, build_norwood_table)
+        return None
+    return entry["insight"]
+
+def load_norwood_table():
+    """Return the fresh entries stored on disk for the current model and prompt."""
+    try:
+        stored = json.loads(NORWOOD_TABLE_PATH.read_text())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Failed to load precomputed Gemini insights from {NORWOOD_TABLE_PATH}: {e}")
+        return {}
+    if not isinstance(stored, dict) or stored.get("version") != NORWOOD_TABLE_VERSION:
+        print(f"Ignoring precomputed Gemini insights in {NORWOOD_TABLE_PATH}: generated for another model or prompt.")
+        return {}
+    return {scale: entry for scale, entry in stored.get("entries", {}).items() if is_fresh_norwood_entry(entry)}
+
+def is_norwood_table_locked():
+    """True while the lock file exists and is younger than NORWOOD_TABLE_LOCK_STALE."""
+    try:
+        return time.time() - os.stat(NORWOOD_TABLE_LOCK_PATH).st_mtime < NORWOOD_TABLE_LOCK_STALE
+    except FileNotFoundError:
+        return False
+
+def acquire_norwood_table_lock():
+    """Create the lock file; returns False while another live worker holds it."""
+    while True:
+        try:
+            fd = os.open(NORWOOD_TABLE_LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if is_norwood_table_locked():
+                return False
+            release_norwood_table_lock() # Stale or just released; try again
+            continue
+        except OSError as e:
+            # e.g. a read-only directory: the table can't be saved either, so just generate it in memory
+            print(f"Could not create {NORWOOD_TABLE_LOCK_PATH}, precomputing without it: {e}")
+            return True
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return True
+
+def release_norwood_table_lock():
+    try:
+        os.remove(NORWOOD_TABLE_LOCK_PATH)
+    except FileNotFoundError:
+        pass
+
+def refresh_norwood_table():
+    """Merge the fresh entries on disk into NORWOOD_TABLE and return the scales still missing."""
+    global NORWOOD_TABLE
+    table = {scale: entry for scale, entry in NORWOOD_TABLE.items() if is_fresh_norwood_entry(entry)}
+    stored = load_norwood_table()
+    if stored:
+        print(f"Loaded precomputed Gemini insights for {len(stored)} Norwood scales.")
+    table.update(stored)
+    NORWOOD_TABLE = table
+    return [scale for scale in NORWOOD_SCALES if scale not in table]
+
+def build_norwood_table():
+    """Load NORWOOD_TABLE from disk, then generate and persist any scales missing or expired."""
+    while True:
+        missing_scales = refresh_norwood_table()
+        if not missing_scales or not gemini_model:
+            return
+        if acquire_norwood_table_lock():
+            break
+        # Another worker is generating; wait for it to finish, then pick up what it wrote
+        print("Waiting for another worker to precompute Gemini insights...")
+        while is_norwood_table_locked():
+            time.sleep(1)
+
+    try:
+        generate_norwood_entries(missing_scales)
+    finally:
+        release_norwood_table_lock()
+
+def generate_norwood_entries(missing_scales):
+    """Generate the given scales into NORWOOD_TABLE and save the table if any were added."""
+    global NORWOOD_TABLE
+    # Queue every missing scale at once so the batcher can group them into a couple of Gemini calls;
+    # they all run concurrently, so they share one deadline rather than each getting its own
+    pending = {scale: submit_gemini_report(scale) for scale in missing_scales}
+    deadline = time.monotonic() + GEMINI_BATCH_TIMEOUT
+    changed = False
+    for scale, future in pending.items():
+        try:
+            raw_insight = future.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception as e:
+            print(f"Failed to precompute Gemini insight for Norwood Scale {scale}: {e}")
+            continue
+        # A report that didn't follow the template would be served for the whole TTL, so only keep
+        # complete ones and leave the rest to live requests and the next rebuild
+        # (at least one issue has to carry a real percentage, not just the 0% fallback)
+        sections, _ = split_gemini_report(raw_insight)
+        if len(sections) != len(HEADER_TO_KEY) or not _ISSUE_RE.search(sections['main_issues']):
+            print(f"Discarding incomplete precomputed Gemini insight for Norwood Scale {scale}.")
+            continue
+        NORWOOD_TABLE = {**NORWOOD_TABLE, scale: {"generated_at": time.time(), "insight": parse_gemini_insight(raw_insight, scale)}}
+        changed = True
+
+    if not changed:
+        return
+    try:
+        # Write a uniquely named file then rename it, so other workers never read a half-written table
+        with tempfile.NamedTemporaryFile('w', dir=NORWOOD_TABLE_PATH.parent, suffix='.tmp', delete=False) as tmp_file:
+            json.dump({"version": NORWOOD_TABLE_VERSION, "entries": NORWOOD_TABLE}, tmp_file)
+        os.replace(tmp_file.name, NORWOOD_TABLE_PATH)
+    except Exception as e:
+        print(f"Failed to save precomputed Gemini insights to {NORWOOD_TABLE_PATH}: {e}")
+
+def configure_gemini_and_precompute():
+    configure_gemini()
+    if gemini_model:
+        # Build (or finish) the table once Gemini is usable; scales already loaded or generated are skipped
+        start_background_task(_norwood_building, build_norwood_table)
 
 # --- Initialize Gradio Client ---
 gradio_client = None
@@ -58,6 +465,7 @@ gradio_client = None
 def initialize_gradio_client():
     global gradio_client
     try:
+        from gradio_client import Client
         print("Attempting to connect to Gradio client for Julienajd/BaldnessDetector...")
         gradio_client = Client("Julienajd/BaldnessDetector", hf_token=HF_TOKEN)
         print("Successfully connected to Gradio client!")
@@ -65,43 +473,205 @@ def initialize_gradio_client():
         print(f"Failed to connect to Gradio client: {e}")
         gradio_client = None
 
-# Initialize Gradio client on startup
-initialize_gradio_client()
+def predict_norwood(image_source):
+    """Run the BaldnessDetector Space on an image URL; returns (Norwood_Scale, Image_Path)."""
+    from gradio_client import handle_file
+    return gradio_client.predict(
+        filepath=handle_file(image_source), # handle_file can take URL
+        api_name="/predict"
+    )
+
+# --- Prediction cache ---
+# Finished responses keyed by sha1(image URL), plus the image's perceptual hash so
+# re-uploads of the same photo under a new URL also skip the Gradio + Gemini round-trips.
+# Process-local: each gunicorn worker keeps its own copy.
+PREDICTION_CACHE_TTL = 3600 # seconds
+_pred_cache = TTLCache(maxsize=1024, ttl=PREDICTION_CACHE_TTL)
+_pred_cache_lock = threading.Lock() # TTLCache is not thread-safe
+
+def get_cached_prediction(key):
+    with _pred_cache_lock:
+        return _pred_cache.get(key)
+
+def cache_prediction(keys, response):
+    with _pred_cache_lock:
+        for key in keys:
+            _pred_cache[key] = response
+
+def compute_image_phash(image_bytes):
+    """Return a cache key from the image's perceptual hash, or None if it can't be decoded."""
+    try:
+        import imagehash
+        from PIL import Image
+        return f"phash:{imagehash.phash(Image.open(io.BytesIO(image_bytes)))}"
+    except Exception as e:
+        print(f"Could not compute perceptual hash: {e}")
+        return None
+
+# --- Input image prefetch ---
+# The user's image is downloaded over a pooled keep-alive session only to compute its perceptual hash;
+# Gradio still gets the URL, since handle_file(url) has the Space fetch it rather than this server, and
+# runs alongside the prefetch.
+# pool_maxsize covers gunicorn's 16 threads per worker with headroom, so bursts reuse connections
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+# The URL comes straight from the client, so only https is fetched and the body size and total download
+# time are capped (requests' timeout only bounds each socket read, not the whole body)
+MAX_PREFETCH_BYTES = 20 * 1024 * 1024
+PREFETCH_CHUNK_SIZE = 64 * 1024
+PREFETCH_DEADLINE = 10 # seconds
+
+def fetch_image_bytes(image_url):
+    """Download the image at an https URL; raises ValueError if it's not https, over MAX_PREFETCH_BYTES or
+    takes longer than PREFETCH_DEADLINE."""
+    if urlsplit(image_url).scheme != 'https':
+        raise ValueError("only https image URLs are prefetched")
+    deadline = time.monotonic() + PREFETCH_DEADLINE
+    with _http.get(image_url, timeout=PREFETCH_DEADLINE, stream=True) as resp:
+        resp.raise_for_status()
+        content_length = resp.headers.get('Content-Length')
+        if content_length and int(content_length) > MAX_PREFETCH_BYTES:
+            raise ValueError(f"image is {content_length} bytes, over the {MAX_PREFETCH_BYTES} byte limit")
+        image_bytes = bytearray()
+        for chunk in resp.iter_content(PREFETCH_CHUNK_SIZE):
+            image_bytes += chunk
+            # Content-Length may be missing or wrong, so enforce the limit on what actually arrives
+            if len(image_bytes) > MAX_PREFETCH_BYTES:
+                raise ValueError(f"image is over the {MAX_PREFETCH_BYTES} byte limit")
+            if time.monotonic() > deadline:
+                raise ValueError(f"image took over {PREFETCH_DEADLINE}s to download")
+    return bytes(image_bytes)
+
+def fetch_image_phash(image_url):
+    """Prefetch the image and return its perceptual-hash cache key, or None if either step fails."""
+    try:
+        image_bytes = fetch_image_bytes(image_url)
+    except Exception as e:
+        # Gradio fetches the URL itself; only the perceptual-hash cache is lost
+        print(f"Could not prefetch image from {image_url}: {e}")
+        return None
+    return compute_image_phash(image_bytes)
+
+# --- Background tasks ---
+_background_guard = threading.Lock()
+
+def start_background_task(running, task):
+    """Run task() on a daemon thread unless the one tracked by the `running` event is still in flight."""
+    with _background_guard:
+        if running.is_set():
+            return
+        running.set()
+
+    def run():
+        try:
+            task()
+        finally:
+            running.clear()
+
+    threading.Thread(target=run, daemon=True).start()
+
+# --- One-time client initialization ---
+# Each client is connected once, under its own lock, by whoever needs it first; concurrent callers wait
+# for that connect instead of starting their own, and a failed connect is retried by the next caller.
+_gradio_init_lock = threading.Lock()
+_gemini_init_lock = threading.Lock()
+
+def ensure_gradio_client():
+    """Connect the Gradio client unless it already is; returns it, or None if connecting failed."""
+    if not gradio_client:
+        with _gradio_init_lock:
+            if not gradio_client:
+                initialize_gradio_client()
+    return gradio_client
+
+def ensure_gemini_model():
+    """Configure Gemini unless it already is; returns the model, or None if configuring failed."""
+    if not gemini_model:
+        with _gemini_init_lock:
+            if not gemini_model:
+                configure_gemini_and_precompute()
+    return gemini_model
+
+# --- Startup ---
+# Importing the app (and booting a gunicorn worker) doesn't wait on the SDK imports and network
+# handshakes: both clients start connecting on warm-up threads, and a request that arrives before they
+# finish waits on the init lock for the connect in progress rather than getting a 503.
+threading.Thread(target=ensure_gemini_model, daemon=True).start()
+threading.Thread(target=ensure_gradio_client, daemon=True).start()
 
 # --- Middleware to check client initialization ---
 @app.before_request
 def check_clients():
-    global gradio_client, gemini_model
-    if not gradio_client:
-        initialize_gradio_client()
-        if not gradio_client:
-            return jsonify({"error": "Gradio client not initialized. Please try again later."}), 503
-    if not gemini_model:
-        configure_gemini() # Try to re-configure Gemini if it failed
-        if not gemini_model:
-            return jsonify({"error": "Google AI Studio model not initialized. Please check API key."}), 503
+    if not ensure_gradio_client():
+        return ojsonify({"error": "Gradio client not initialized. Please try again later."}), 503
+    if not ensure_gemini_model(): # Try to re-configure Gemini if it failed
+        return ojsonify({"error": "Google AI Studio model not initialized. Please check API key."}), 503
+
+# --- Fallback response when the hair analysis fails ---
+# Without a Norwood scale Gemini can only produce generic text, so it is skipped and this fixed body
+# (same shape as a normal response) is returned instead.
+_ERROR_FALLBACK_RESPONSE = {
+    "label": "Norwood Scale: N/A (Gradio failed)",
+    "symptoms": "Failed to generate insights.",
+    "main_issues": [{"issue": "Analysis unavailable", "percentage": 0}],
+    "overall_health_percentage": "N/A",
+    "causes": "Failed to generate insights.",
+    "treatments": "Failed to generate insights.",
+    "confidences": [
+        {"label": "Norwood Scale N/A (Gradio failed)", "score": 0.0}
+    ],
+    "gemini_raw_insight": "Skipped: the hair analysis (Gradio) failed, so no insight was generated.",
+    "segmentation_image_url": None
+}
 
 @app.route('/predict-hair', methods=['POST'])
-def predict_hair():
+async def predict_hair():
     data = request.json
     image_url = data.get('imageUrl')
+    deep_analysis = data.get('deep') is True # Ask Gemini about this specific image instead of the precomputed report
 
     if not image_url:
-        return jsonify({"error": "imageUrl is required"}), 400
+        return ojsonify({"error": "imageUrl is required"}), 400
 
     print(f"Received request for hair prediction with image URL: {image_url}")
 
+    # Deep and precomputed answers for the same image differ, so they are cached under separate keys
+    cache_key_suffix = ":deep" if deep_analysis else ""
+    url_key = hashlib.sha1(image_url.encode()).hexdigest() + cache_key_suffix
+    cached_response = get_cached_prediction(url_key)
+    if cached_response:
+        print("Prediction cache hit (image URL).")
+        return ojsonify(cached_response), 200
+
+    # Step 1: Call Gradio BaldnessDetector
+    # Gradio gets the URL rather than the prefetched bytes, so it starts straight away and the prefetch and
+    # perceptual hash run alongside it; a perceptual-hash cache hit just abandons the Gradio result
+    print("Calling Gradio BaldnessDetector...")
+    gradio_future = run_blocking(predict_norwood, image_url)
+    try:
+        # The socket timeout alone doesn't bound a slow download, so don't wait past the deadline either
+        phash_key = await asyncio.wait_for(run_blocking(fetch_image_phash, image_url), PREFETCH_DEADLINE)
+    except asyncio.TimeoutError:
+        print(f"Prefetching {image_url} took over {PREFETCH_DEADLINE}s; skipping the perceptual-hash cache.")
+        phash_key = None
+
+    if phash_key:
+        phash_key += cache_key_suffix
+        cached_response = get_cached_prediction(phash_key)
+        if cached_response:
+            print("Prediction cache hit (perceptual hash).")
+            gradio_future.cancel()
+            cache_prediction([url_key], cached_response)
+            return ojsonify(cached_response), 200
+
     norwood_scale = "N/A"
-    hair_segmentation_image_data = None
-    mime_type = None
+    gradio_ok = True
+    gemini_ok = False
+    hair_segmentation_image_path = None
 
     try:
-        # Step 1: Call Gradio BaldnessDetector
-        print("Calling Gradio BaldnessDetector...")
-        gradio_result = gradio_client.predict(
-            filepath=handle_file(image_url), # handle_file can take URL
-            api_name="/predict"
-        )
+        gradio_result = await gradio_future
         print(f"Gradio Client prediction raw result: {gradio_result}")
 
         # Gradio result is a tuple/list: (Norwood_Scale, Image_Path)
@@ -110,28 +680,23 @@ def predict_hair():
 
         print(f"Norwood Scale: {norwood_scale}, Segmentation Image Path: {segmentation_image_path}")
 
-        # Step 2: Read the segmentation image file into bytes for Gemini
-        if os.path.exists(segmentation_image_path):
-            with open(segmentation_image_path, 'rb') as img_file:
-                hair_segmentation_image_data = img_file.read()
-
-            mime_type, _ = mimetypes.guess_type(segmentation_image_path)
-            if not mime_type: # Fallback for unknown mime types
-                mime_type = 'image/jpeg' # Most common web image types work
-            print(f"Segmentation image read successfully. MIME type: {mime_type}")
-        else:
+        # Step 2: Check the segmentation image exists and isn't empty; it is streamed to Gemini's file API below
+        if not os.path.exists(segmentation_image_path):
             print(f"Warning: Segmentation image file not found at {segmentation_image_path}. Gemini will not receive image.")
-            # hair_segmentation_image_data remains None
+            # hair_segmentation_image_path remains None
+        elif os.path.getsize(segmentation_image_path) == 0:
+            print(f"Warning: Segmentation image file at {segmentation_image_path} is empty. Gemini will not receive image.")
+        else:
+            hair_segmentation_image_path = segmentation_image_path
 
     except Exception as e:
         print(f"Error during Gradio prediction: {e}")
         import traceback
         traceback.print_exc()
-        # Continue to Gemini step, but note the Gradio failure
-        norwood_scale = "N/A (Gradio failed)"
-        hair_segmentation_image_data = None
-        mime_type = None
+        gradio_ok = False
 
+    if not gradio_ok:
+        return ojsonify(_ERROR_FALLBACK_RESPONSE), 502
 
     # Step 3: Call Google AI Studio (Gemini) with combined information and specific prompt
     gemini_symptoms = "N/A"
@@ -140,116 +705,30 @@ def predict_hair():
     gemini_causes = "N/A"
     gemini_treatments = "N/A"
     gemini_raw_insight = "Failed to generate detailed insight."
+    uploaded_image = None
 
     try:
         if gemini_model:
-            # --- UPDATED GEMINI PROMPT with 'Confidence' phrasing ---
-            gemini_prompt_text = f"""
-Based on a hair analysis result showing **Norwood Scale {norwood_scale}**, and considering the provided hair segmentation image (if available), generate a structured report. This report aims to provide confidence in the hair analysis.
-
-**SYMPTOMS:**
-Describe the typical observable symptoms for Norwood Scale {norwood_scale}. Max 2 lines.
-
-**MAIN ISSUES (Confidence in Specific Concerns):**
-List up to 4 primary hair loss issues commonly associated with this Norwood Scale. For each, provide *only* the issue name and an estimated percentage, formatted strictly as "Issue Name (Percentage%)". These are AI estimations. No conversational text or extra explanations for each issue.
-
-**OVERALL HAIR HEALTH PERCENTAGE (Overall Confidence):**
-Based on Norwood Scale {norwood_scale}, provide an estimated overall hair health percentage, e.g., "95%". This is an AI estimation of the overall condition.
-
-**CAUSES:**
-Explain common underlying causes for hair loss at this Norwood Scale. Max 2 lines.
-
-**TREATMENTS:**
-List general management or treatment approaches for this Norwood Scale. Keep it concise. Max 4 lines.
-            """
-            # --- END UPDATED GEMINI PROMPT ---
-
-            gemini_prompt_parts = [gemini_prompt_text]
-
-            if hair_segmentation_image_data and mime_type:
-                gemini_prompt_parts.append({
-                    'mime_type': mime_type,
-                    'data': hair_segmentation_image_data
-                })
-
-            print("Sending request to Google AI Studio (Gemini)...")
-            gemini_response_obj = gemini_model.generate_content(gemini_prompt_parts)
-            gemini_raw_insight = gemini_response_obj.text
-            print(f"Gemini Raw Response:\n{gemini_raw_insight}")
-
-            # --- IMPROVED PARSING OF GEMINI'S RESPONSE ---
-            # Define sections and their corresponding keys. Ensure these match the prompt headers exactly.
-            sections_mapping = {
-                "SYMPTOMS:": "symptoms",
-                "MAIN ISSUES (Confidence in Specific Concerns):": "main_issues",
-                "OVERALL HAIR HEALTH PERCENTAGE (Overall Confidence):": "overall_health_percentage",
-                "CAUSES:": "causes",
-                "TREATMENTS:": "treatments"
-            }
-            parsed_content = {}
-
-            temp_text = gemini_raw_insight
-            # Add a unique delimiter before each known section header to help split
-            # Iterate through actual headers from sections_mapping keys to replace them correctly
-            for header_text_in_prompt in sections_mapping.keys():
-                # Handle both bolded and non-bolded headers
-                temp_text = temp_text.replace(f"**{header_text_in_prompt}**", f"---SECTION_DELIMITER---{header_text_in_prompt}")
-                temp_text = temp_text.replace(f"{header_text_in_prompt}", f"---SECTION_DELIMITER---{header_text_in_prompt}")
-
-
-            sections_raw = temp_text.split("---SECTION_DELIMITER---")
-
-            for section_block in sections_raw:
-                section_block = section_block.strip()
-                if not section_block:
-                    continue
-
-                found_header = False
-                for header_text_in_prompt, key_name in sections_mapping.items():
-                    if section_block.startswith(header_text_in_prompt):
-                        # Extract content after the header, and remove leading/trailing whitespace
-                        content = section_block[len(header_text_in_prompt):].strip()
-                        parsed_content[key_name] = content
-                        found_header = True
-                        break
-
-            # Assign parsed data to variables, applying .replace('*', '').strip() for cleanliness
-            gemini_symptoms = parsed_content.get('symptoms', "No symptoms insight provided.").replace('*', '').strip()
-            gemini_causes = parsed_content.get('causes', "No causes insight provided.").replace('*', '').strip()
-            gemini_treatments = parsed_content.get('treatments', "No treatment insight provided.").replace('*', '').strip()
-            gemini_overall_health_percentage = parsed_content.get('overall_health_percentage', "N/A").replace('*', '').strip()
-
-            # Parse Main Issues (Most Critical Part to get right)
-            main_issues_raw = parsed_content.get('main_issues', "")
-            gemini_main_issues = []
-            # Regex to capture: Optional list marker (- or *) followed by issue name (non-greedy)
-            # followed by optional space, then (percentage%), then optional extra text on the same line
-            issue_line_pattern = re.compile(r"^(?:[-*]\s*)?(.+?)\s*\((\d+)%\)")
-
-            for line in main_issues_raw.split('\n'):
-                line = line.strip()
-                if not line:
-                    continue
-                match = issue_line_pattern.match(line)
-                if match:
-                    issue_name = match.group(1).strip()
-                    issue_percent = int(match.group(2))
-                    gemini_main_issues.append({"issue": issue_name, "percentage": issue_percent})
-                else:
-                    # Fallback if regex fails, try to get just the text, assuming 0%
-                    if "(" in line and ")" in line: # Try a last ditch effort to extract if parenthesis exist
-                        try:
-                            name_part = line.split('(')[0].strip()
-                            percent_part = line.split('(')[1].replace('%)','').replace('%','').strip()
-                            gemini_main_issues.append({"issue": name_part, "percentage": int(percent_part)})
-                        except (ValueError, IndexError):
-                            gemini_main_issues.append({"issue": line, "percentage": 0})
-                    else:
-                        gemini_main_issues.append({"issue": line, "percentage": 0})
-
-            # Ensure there's at least one main issue if a Norwood scale was detected
-            if not gemini_main_issues and norwood_scale != "N/A":
-                gemini_main_issues.append({"issue": f"Hair loss consistent with Norwood Scale {norwood_scale}", "percentage": 100})
+            # The report is almost entirely a function of the Norwood scale, so serve the precomputed one
+            # unless the client asked for a deep analysis that also looks at the segmentation image
+            insight = None if deep_analysis else get_norwood_insight(norwood_scale)
+            if insight:
+                print(f"Using precomputed Gemini insight for Norwood Scale {norwood_scale}.")
+            else:
+                if hair_segmentation_image_path:
+                    # Stream the file to Gemini's file store and reference it by URI instead of inlining the bytes
+                    uploaded_image = await run_blocking(upload_gemini_image, hair_segmentation_image_path)
+
+                print("Sending request to Google AI Studio (Gemini)...")
+                insight = await run_blocking(generate_gemini_insight, norwood_scale, uploaded_image)
+
+            gemini_raw_insight = insight["gemini_raw_insight"]
+            gemini_symptoms = insight["symptoms"]
+            gemini_main_issues = insight["main_issues"]
+            gemini_overall_health_percentage = insight["overall_health_percentage"]
+            gemini_causes = insight["causes"]
+            gemini_treatments = insight["treatments"]
+            gemini_ok = True
 
         else:
             print("Gemini model not initialized. Skipping Gemini insight generation.")
@@ -265,6 +744,10 @@ List general management or treatment approaches for this Norwood Scale. Keep it
         gemini_overall_health_percentage = "N/A"
         gemini_causes = "Failed to generate insights."
         gemini_treatments = "Failed to generate insights."
+    finally:
+        if uploaded_image:
+            # Clean up off the request path so uploads don't pile up against the file quota
+            _EXECUTOR.submit(delete_uploaded_file, uploaded_image)
 
     # Step 4: Structure the final response for Flutter
     # This structure is what Flutter's _callBackend receives and uses for display/storage
@@ -282,8 +765,13 @@ List general management or treatment approaches for this Norwood Scale. Keep it
         "segmentation_image_url": segmentation_image_path # Local path on backend, not directly usable by Flutter
     }
 
-    return jsonify(structured_response), 200
+    # Only cache complete results so a transient Gemini failure is retried next time
+    if gemini_ok:
+        cache_prediction([url_key, phash_key] if phash_key else [url_key], structured_response)
+
+    return ojsonify(structured_response), 200
 
+# Local development only: production runs under gunicorn (see Procfile)
 if __name__ == '__main__':
     PORT = int(os.getenv("PORT", 3002)) # Default to 3002
-    app.run(debug=True, host='0.0.0.0', port=PORT)
\ No newline at end of file
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", host='0.0.0.0', port=PORT)
\ No newline at end of file